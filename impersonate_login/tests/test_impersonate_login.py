@@ -2,66 +2,76 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl)
 
 import json
-from uuid import uuid4
 
+from odoo import SUPERUSER_ID, api, registry
 from odoo.tests import HttpCase, tagged
+from odoo.tests.common import get_db_name
 from odoo.tools import mute_logger
 
 
 @tagged("post_install", "-at_install")
 class TestImpersonateLogin(HttpCase):
+    # The request id is not checked: build the constant body only once
+    _session_info_body = json.dumps({"jsonrpc": "2.0", "method": "call", "id": 1})
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # HttpCase has no class-level environment in this version: resolve
+        # the xmlids once here and only browse them in each test's setUp
+        with registry(get_db_name()).cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            cls.admin_user_id = env.ref("base.user_admin").id
+            cls.demo_user_id = env.ref("base.user_demo").id
+            cls.group_impersonate_id = env.ref(
+                "impersonate_login.group_impersonate_login"
+            ).id
+            cls.group_system_id = env.ref("base.group_system").id
+
     def setUp(self):
         super().setUp()
-        self.admin_user = self.env.ref("base.user_admin")
-        self.demo_user = self.env.ref("base.user_demo")
+        self.admin_user = self.env["res.users"].browse(self.admin_user_id)
+        self.demo_user = self.env["res.users"].browse(self.demo_user_id)
+        self.group_impersonate = self.env["res.groups"].browse(
+            self.group_impersonate_id
+        )
+        self.group_system = self.env["res.groups"].browse(self.group_system_id)
+        # Every call below is JSON-RPC: set the header once on the shared opener
+        self.opener.headers["Content-Type"] = "application/json"
 
-    def _impersonate_user(self, user):
+    def _call(self, model, method, args=(), endpoint="/web/dataset/call_button"):
         response = self.url_open(
-            "/web/dataset/call_button",
+            endpoint,
             data=json.dumps(
                 {
                     "params": {
-                        "model": "res.users",
-                        "method": "impersonate_login",
-                        "args": [user.id],
+                        "model": model,
+                        "method": method,
+                        "args": list(args),
                         "kwargs": {},
                     },
                 }
             ),
-            headers={"Content-Type": "application/json"},
         )
         self.assertEqual(response.status_code, 200)
         return response.json()
 
+    def _impersonate_user(self, user):
+        return self._call("res.users", "impersonate_login", [user.id])
+
     def _action_impersonate_login(self):
-        response = self.url_open(
-            "/web/dataset/call_button",
-            data=json.dumps(
-                {
-                    "params": {
-                        "model": "res.users",
-                        "method": "action_impersonate_login",
-                        "args": [],
-                        "kwargs": {},
-                    },
-                }
-            ),
-            headers={"Content-Type": "application/json"},
-        )
-        self.assertEqual(response.status_code, 200)
-        return response.json()
+        return self._call("res.users", "action_impersonate_login")
 
     def _get_session_info(self):
         response = self.url_open(
             "/web/session/get_session_info",
-            data=json.dumps(dict(jsonrpc="2.0", method="call", id=str(uuid4()))),
-            headers={"Content-Type": "application/json"},
+            data=self._session_info_body,
         )
         self.assertEqual(response.status_code, 200)
         return response.json()
 
-    def test_01_admin_impersonates_user_demo(self):
-        """Admin user impersonates Demo user"""
+    def test_01a_admin_session_info(self):
+        """Admin user session before impersonating"""
         # Login as admin
         self.authenticate(user="admin", password="admin")
         self.assertEqual(self.session.uid, self.admin_user.id)
@@ -80,6 +90,11 @@ class TestImpersonateLogin(HttpCase):
         result = data["result"]
         self.assertEqual(result["target"], "new")
 
+    def test_01b_admin_impersonates_user_demo(self):
+        """Admin user impersonates Demo user"""
+        # Login as admin
+        self.authenticate(user="admin", password="admin")
+
         # Impersonate demo user
         data = self._impersonate_user(self.demo_user)
         result = data["result"]
@@ -107,6 +122,24 @@ class TestImpersonateLogin(HttpCase):
             result["data"]["message"], "You are already Logged as another user."
         )
 
+    def test_01c_admin_back_from_user_demo(self):
+        """Admin user goes back to its own session after impersonating Demo user"""
+        # Login as admin and impersonate demo user
+        self.authenticate(user="admin", password="admin")
+        self.assertEqual(
+            self._impersonate_user(self.demo_user)["result"]["tag"], "reload"
+        )
+        log1 = self.env["impersonate.log"].search([], order="id desc", limit=1)
+        self.assertTrue(log1)
+
+        # Impersonate demo user again: rejected, the way back still works
+        with mute_logger("odoo.http"):
+            data = self._impersonate_user(self.demo_user)
+        self.assertEqual(
+            data["error"]["data"]["message"],
+            "You are already Logged as another user.",
+        )
+
         # Back to original user
         data = self._impersonate_user(self.admin_user)
         result = data["result"]
@@ -121,16 +154,19 @@ class TestImpersonateLogin(HttpCase):
         self.assertTrue(result["is_impersonate_user"])
         self.assertFalse(result["impersonate_from_uid"])
 
-        # Check impersonate log
-        log2 = self.env["impersonate.log"].search([], order="id desc", limit=1)
-        # Refresh the log1 after the attribute date_end is updated
-        log1.refresh()
-        self.assertEqual(log1, log2)
-        self.assertTrue(log1.date_start)
-        self.assertTrue(log1.date_end)
+        # Check impersonate log: date_end was written by the request, read the
+        # latest log straight from the database rather than refreshing log1
+        self.env.cr.execute(
+            "SELECT id, date_start, date_end FROM impersonate_log"
+            " ORDER BY id DESC LIMIT 1"
+        )
+        log2_id, date_start, date_end = self.env.cr.fetchone()
+        self.assertEqual(log2_id, log1.id)
+        self.assertTrue(date_start)
+        self.assertTrue(date_end)
 
-    def test_02_user_demo_impersonates_admin(self):
-        """Demo user impersonates Admin user"""
+    def test_02a_user_demo_impersonates_itself(self):
+        """Demo user cannot impersonate itself"""
         # Login as demo user
         self.authenticate(user="demo", password="demo")
         self.assertEqual(self.session.uid, self.demo_user.id)
@@ -142,14 +178,18 @@ class TestImpersonateLogin(HttpCase):
         self.assertFalse(result["impersonate_from_uid"])
 
         # Impersonate demo user: is already current user
-        self.demo_user.groups_id += self.env.ref(
-            "impersonate_login.group_impersonate_login"
-        )
+        self.demo_user.groups_id += self.group_impersonate
         with mute_logger("odoo.http"):
             data = self._impersonate_user(self.demo_user)
         result = data["error"]
         self.assertEqual(result["data"]["message"], "It's you.")
 
+    def test_02b_user_demo_impersonates_admin(self):
+        """Demo user impersonates Admin user"""
+        # Login as demo user, with the impersonation group
+        self.authenticate(user="demo", password="demo")
+        self.demo_user.groups_id += self.group_impersonate
+
         # Impersonate admin user
         data = self._impersonate_user(self.admin_user)
         result = data["result"]
@@ -172,6 +212,28 @@ class TestImpersonateLogin(HttpCase):
             result["data"]["message"], "You are already Logged as another user."
         )
 
+    def test_02c_user_demo_back_from_admin(self):
+        """Demo user goes back to its own session after impersonating Admin user"""
+        # Login as demo user, with the impersonation group
+        self.authenticate(user="demo", password="demo")
+        self.demo_user.groups_id += self.group_impersonate
+
+        # Impersonate demo user: rejected as it is the current user
+        with mute_logger("odoo.http"):
+            data = self._impersonate_user(self.demo_user)
+        self.assertEqual(data["error"]["data"]["message"], "It's you.")
+
+        # Impersonate admin user, then again: rejected, the way back still works
+        self.assertEqual(
+            self._impersonate_user(self.admin_user)["result"]["tag"], "reload"
+        )
+        with mute_logger("odoo.http"):
+            data = self._impersonate_user(self.admin_user)
+        self.assertEqual(
+            data["error"]["data"]["message"],
+            "You are already Logged as another user.",
+        )
+
         # Back to original user
         data = self._impersonate_user(self.demo_user)
         result = data["result"]
@@ -195,26 +257,12 @@ class TestImpersonateLogin(HttpCase):
         # Impersonate demo user and create a contact
         self._impersonate_user(self.demo_user)
 
-        response = self.url_open(
-            "/web/dataset/call_kw/res.partner/create",
-            data=json.dumps(
-                {
-                    "params": {
-                        "model": "res.partner",
-                        "method": "create",
-                        "args": [
-                            {
-                                "name": "Contact123",
-                            },
-                        ],
-                        "kwargs": {},
-                    },
-                }
-            ),
-            headers={"Content-Type": "application/json"},
+        data = self._call(
+            "res.partner",
+            "create",
+            [{"name": "Contact123"}],
+            endpoint="/web/dataset/call_kw/res.partner/create",
         )
-        self.assertEqual(response.status_code, 200)
-        data = response.json()
         contact_id = data["result"]
 
         contact = self.env["res.partner"].browse(contact_id)
@@ -233,32 +281,17 @@ class TestImpersonateLogin(HttpCase):
         # Impersonate demo user and modify a contact
         self._impersonate_user(self.demo_user)
 
-        response = self.url_open(
-            "/web/dataset/call_kw/res.partner/write",
-            data=json.dumps(
-                {
-                    "params": {
-                        "model": "res.partner",
-                        "method": "write",
-                        "args": [
-                            [contact.id],
-                            {
-                                "ref": "abc",
-                            },
-                        ],
-                        "kwargs": {},
-                    },
-                }
-            ),
-            headers={"Content-Type": "application/json"},
+        data = self._call(
+            "res.partner",
+            "write",
+            [[contact.id], {"ref": "abc"}],
+            endpoint="/web/dataset/call_kw/res.partner/write",
         )
-        self.assertEqual(response.status_code, 200)
-        data = response.json()
         result = data["result"]
 
         # Refresh contact to reflect changes in the database
         self.assertEqual(result, True)
-        contact.invalidate_cache()
+        contact.invalidate_cache(fnames=["ref", "write_uid"], ids=contact.ids)
         self.assertEqual(contact.ref, "abc")
         self.assertEqual(contact.write_uid, self.admin_user)
 
@@ -267,6 +300,11 @@ class TestImpersonateLogin(HttpCase):
         Test restriction on impersonating admin users
         with 'Administration: Settings' access rights.
         """
+        # Ensure the admin user has the 'Administration: Settings' group and
+        # give demo user the impersonation group, before the settings execute
+        self.admin_user.write({"groups_id": [(4, self.group_system.id)]})
+        self.demo_user.write({"groups_id": [(4, self.group_impersonate.id)]})
+
         # Enable the configuration setting via ResConfigSettings
         config_settings = self.env["res.config.settings"].create(
             {"restrict_impersonate_admin_settings": True}
@@ -281,19 +319,10 @@ class TestImpersonateLogin(HttpCase):
         )
         self.assertTrue(config_restrict)
 
-        # Ensure the admin user has the 'Administration: Settings' group
-        admin_settings_group = self.env.ref("base.group_system")
-        self.admin_user.groups_id += admin_settings_group
-
         # Login as demo user
         self.authenticate(user="demo", password="demo")
         self.assertEqual(self.session.uid, self.demo_user.id)
 
-        # Give demo user the impersonation group
-        self.demo_user.groups_id += self.env.ref(
-            "impersonate_login.group_impersonate_login"
-        )
-
         with mute_logger("odoo.http"):
             data = self._impersonate_user(self.admin_user)
         # Validate the error message